@@ -1,23 +1,123 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 import os
+from typing import Optional
 from dotenv import load_dotenv
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
 
+# Connection pool configuration (ignored for SQLite)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 20))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 40))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))
+
+# asyncio driver for the async engine, by DATABASE_URL backend
+_ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+
+
+def _async_url(url: str) -> str:
+    """The DATABASE_URL with its driver swapped for an asyncio one"""
+    url = make_url(url)
+    if driver := _ASYNC_DRIVERS.get(url.get_backend_name()):
+        url = url.set(drivername=f"{url.get_backend_name()}+{driver}")
+    return url.render_as_string(hide_password=False)
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or _async_url(DATABASE_URL)
+
+# An in-memory database only exists on its one connection, so share it.
+# The sync and async engines can't share that connection: use a file
+# database with the WebSocket endpoints.
+_IN_MEMORY = DATABASE_URL.startswith("sqlite") and (
+    ":memory:" in DATABASE_URL or DATABASE_URL.rstrip("/") == "sqlite:"
+)
+
 # Check if the URL is an SQLite URL
 if DATABASE_URL.startswith("sqlite"):
+    if _IN_MEMORY:
+        engine = create_engine(
+            DATABASE_URL,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+    else:
+        engine = create_engine(
+            DATABASE_URL, connect_args={"check_same_thread": False}
+        )
+else:
     engine = create_engine(
-        DATABASE_URL, connect_args={"check_same_thread": False}
+        DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_timeout=DB_POOL_TIMEOUT,
     )
-else:
-    engine = create_engine(DATABASE_URL)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine for the WebSocket endpoints, so their queries don't block
+# the event loop. Created on first use, so a backend without an asyncio
+# driver breaks only the WebSocket endpoints rather than the whole app
+_async_engine: Optional[AsyncEngine] = None
+_async_session_factory: Optional[async_sessionmaker] = None
+
+
+def _create_async_engine() -> AsyncEngine:
+    """Create the async engine with the same pool settings as the sync one"""
+    if ASYNC_DATABASE_URL.startswith("sqlite"):
+        return create_async_engine(
+            ASYNC_DATABASE_URL, poolclass=StaticPool if _IN_MEMORY else None
+        )
+    return create_async_engine(
+        ASYNC_DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+
+
+def get_async_sessionmaker() -> async_sessionmaker:
+    """
+    Get the asyncio session factory, creating the engine on first use.
+
+    Raises:
+        RuntimeError: If ASYNC_DATABASE_URL has no usable asyncio driver
+    """
+    global _async_engine, _async_session_factory
+    if _async_session_factory is None:
+        try:
+            _async_engine = _create_async_engine()
+        except (ImportError, InvalidRequestError) as error:
+            raise RuntimeError(
+                f"Cannot create an asyncio engine for {make_url(ASYNC_DATABASE_URL)!r} "
+                f"({error}); install its asyncio driver or set ASYNC_DATABASE_URL "
+                "to a URL that names one, e.g. postgresql+asyncpg://..."
+            ) from error
+        # Objects stay usable after commit; reloading expired attributes
+        # would need an implicit (and, under asyncio, unsupported) lazy load
+        _async_session_factory = async_sessionmaker(
+            _async_engine, autoflush=False, expire_on_commit=False
+        )
+    return _async_session_factory
+
+
+async def dispose_async_engine():
+    """Close the async engine's pooled connections, if it was ever created"""
+    if _async_engine is not None:
+        await _async_engine.dispose()
+
+
 Base = declarative_base()
 
 
@@ -32,4 +132,15 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+async def get_async_db():
+    """
+    Dependency to get an asyncio database session.
+
+    Yields:
+        AsyncSession: A SQLAlchemy asyncio session.
+    """
+    async with get_async_sessionmaker()() as db:
+        yield db
\ No newline at end of file
@@ -1,14 +1,23 @@
 from fastapi import Depends, HTTPException, status, WebSocket, WebSocketDisconnect
 from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
-from passlib.context import CryptContext
+import jwt
+from jwt import InvalidTokenError as JWTError
+from sqlalchemy import and_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from datetime import datetime, timedelta
+from cachetools import TTLCache
+from dataclasses import dataclass
+from datetime import timedelta
+import asyncio
+import bcrypt
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 from . import models, schemas
-from .database import get_db
+from .database import get_async_db, get_db
 
 load_dotenv()
 
@@ -16,41 +25,200 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "yoursecretkey")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
+ACCESS_TOKEN_EXPIRE = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+JWT_CACHE_TTL = int(os.getenv("JWT_CACHE_TTL", 60))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 30))
+
+_DEFAULT_TOKEN_EXPIRE = timedelta(minutes=15)
+
+# The HMAC signing key, encoded once instead of on every encode/decode
+_SIGNING_KEY = SECRET_KEY.encode()
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Decoded JWT payloads keyed by the raw token string
+_jwt_cache = TTLCache(maxsize=10_000, ttl=JWT_CACHE_TTL)
+_jwt_cache_lock = threading.Lock()
+
+# User records keyed by username
+_user_cache = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL)
+_user_cache_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class UserRecord:
+    """Read-only snapshot of the user columns needed for authentication"""
+    id: int
+    username: str
+    email: str
+    hashed_password: str
+    is_active: bool
+
+
+async def verify_password(plain_password, hashed_password):
+    """Verify that a password matches its hash (runs in a worker thread)"""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, bcrypt.checkpw, plain_password.encode(), hashed_password.encode()
+    )
+
 
-def verify_password(plain_password, hashed_password):
-    """Verify that a password matches its hash"""
-    return pwd_context.verify(plain_password, hashed_password)
+def _hash_password(password: str) -> str:
+    """Generate a salt and hash a password; blocking, call from a worker thread"""
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
 
 
-def get_password_hash(password):
-    """Hash a password"""
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    """Hash a password (runs in a worker thread)"""
+    return await asyncio.get_running_loop().run_in_executor(None, _hash_password, password)
+
+
+async def warm_up_password_hashing():
+    """
+    Hash a throwaway password once so the first login or signup doesn't pay
+    for starting the executor threads and first use of the bcrypt backend
+    """
+    await get_password_hash("warmup")
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
     """Create a JWT token"""
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode["exp"] = expire
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    lifetime = expires_delta or _DEFAULT_TOKEN_EXPIRE
+    # exp is a NumericDate (epoch seconds), so skip datetime arithmetic
+    to_encode["exp"] = int(time.time()) + int(lifetime.total_seconds())
+    return jwt.encode(to_encode, _SIGNING_KEY, algorithm=ALGORITHM)
+
+
+def _decode_token(token: str) -> dict:
+    """
+    Decode and verify a JWT token, caching the payload for a short window.
+
+    A cache entry never outlives the token itself: the ``exp`` claim is
+    checked on every hit and expired entries are evicted.
+
+    Raises:
+        JWTError: If the token is invalid or has expired.
+    """
+    with _jwt_cache_lock:
+        payload = _jwt_cache.get(token)
+    if payload is None:
+        payload = jwt.decode(token, _SIGNING_KEY, algorithms=[ALGORITHM])
+        with _jwt_cache_lock:
+            _jwt_cache[token] = payload
+    exp = payload.get("exp")
+    if exp is not None and exp <= time.time():
+        with _jwt_cache_lock:
+            _jwt_cache.pop(token, None)
+        raise jwt.ExpiredSignatureError("Signature has expired")
+    return payload
+
+
+def _user_query(username: str):
+    """Narrow SELECT of the UserRecord columns for a username"""
+    return select(
+        models.User.id,
+        models.User.username,
+        models.User.email,
+        models.User.hashed_password,
+        models.User.is_active,
+    ).where(models.User.username == username)
+
+
+def _cached_user(username: str):
+    """A cached UserRecord, or None on a cache miss"""
+    with _user_cache_lock:
+        return _user_cache.get(username)
+
+
+def _cache_user(username: str, row):
+    """Cache a user row fetched with _user_query, returning its UserRecord"""
+    if row is None:
+        return None
+
+    user = UserRecord(*row)
+    with _user_cache_lock:
+        _user_cache[username] = user
+    return user
 
 
 def get_user(db: Session, username: str):
-    """Get a user by username"""
-    return db.query(models.User).filter(models.User.username == username).first()
+    """
+    Get a user by username.
+
+    Uses a narrow Core SELECT instead of loading an ORM instance, and keeps
+    the result in a short-lived cache. Unknown usernames are not cached.
+
+    Returns:
+        UserRecord | None: The user, or None if no such user exists.
+    """
+    if (user := _cached_user(username)) is not None:
+        return user
+    return _cache_user(username, db.execute(_user_query(username)).one_or_none())
 
 
-def authenticate_user(db: Session, username: str, password: str):
+async def get_user_async(db: AsyncSession, username: str):
+    """Get a user by username through an asyncio session; see get_user"""
+    if (user := _cached_user(username)) is not None:
+        return user
+    row = (await db.execute(_user_query(username))).one_or_none()
+    return _cache_user(username, row)
+
+
+def invalidate_user_cache(username: str):
+    """Drop a cached user so the next lookup reads it from the database"""
+    with _user_cache_lock:
+        _user_cache.pop(username, None)
+
+
+def get_room_membership(db: Session, room_id: int, user_id: int):
+    """
+    Get a chat room and the user's membership of it in a single query.
+
+    Returns:
+        tuple: ``(room, user_room)``; ``room`` is None if the room does not
+        exist and ``user_room`` is None if the user is not a member.
+    """
+    row = (
+        db.query(models.ChatRoom, models.UserRoom)
+        .outerjoin(
+            models.UserRoom,
+            and_(
+                models.UserRoom.room_id == models.ChatRoom.id,
+                models.UserRoom.user_id == user_id,
+            ),
+        )
+        .filter(models.ChatRoom.id == room_id)
+        .first()
+    )
+    return (row[0], row[1]) if row else (None, None)
+
+
+# Dialects whose INSERT supports ON CONFLICT DO NOTHING
+_UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+async def add_room_member(db: AsyncSession, user_id: int, room_id: int):
+    """
+    Make a user a member of a room unless they already are.
+
+    Issues a single ``INSERT ... ON CONFLICT DO NOTHING`` where the dialect
+    supports it. Does not commit; the caller commits with its other writes.
+    """
+    if insert := _UPSERT_INSERTS.get(db.get_bind().dialect.name):
+        await db.execute(
+            insert(models.UserRoom)
+            .values(user_id=user_id, room_id=room_id)
+            .on_conflict_do_nothing()
+        )
+    else:
+        await db.merge(models.UserRoom(user_id=user_id, room_id=room_id))
+
+
+async def authenticate_user(db: Session, username: str, password: str):
     """Authenticate a user"""
     if user := get_user(db, username):
-        return user if verify_password(password, user.hashed_password) else False
+        return user if await verify_password(password, user.hashed_password) else False
     else:
         return False
 
@@ -63,7 +231,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = _decode_token(token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
@@ -76,7 +244,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     return user
 
 
-async def get_current_active_user(current_user: models.User = Depends(get_current_user)):
+async def get_current_active_user(current_user: UserRecord = Depends(get_current_user)):
     """Get the current active user"""
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
@@ -92,23 +260,27 @@ async def get_token_from_ws_query(websocket: WebSocket):
     return token
 
 
-async def get_user_from_ws_token(websocket: WebSocket, db: Session = Depends(get_db)):
+async def get_user_from_ws_token(websocket: WebSocket, db: AsyncSession = Depends(get_async_db)):
     """
     Authenticate WebSocket connection and get the current user
     Returns None if authentication fails
+
+    Both the token payload and the user record come from short-lived
+    caches, so a client reconnecting with the same token does no
+    cryptographic or database work.
     """
     token = await get_token_from_ws_query(websocket)
     if not token:
         return None
     
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = _decode_token(token)
         username: str = payload.get("sub")
         if username is None:
             await websocket.close(code=1008, reason="Invalid token")
             return None
         
-        user = get_user(db, username=username)
+        user = await get_user_async(db, username=username)
         if user is None or not user.is_active:
             await websocket.close(code=1008, reason="User not found or inactive")
             return None
@@ -1,22 +1,28 @@
 import contextlib
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.orm import Session
 import os
 import json
 
 from . import models
-from .database import engine, get_db
+from .database import dispose_async_engine, engine, get_db
+from .dependencies import warm_up_password_hashing
+from .message_writer import message_writer
 from .routers import api, websocket
 from .websocket_manager import manager
 
-# Create database tables
-models.Base.metadata.create_all(bind=engine)
+# Create missing database tables at startup. Opt-in, so multi-worker
+# deployments don't all introspect the schema on boot; manage the schema
+# with migrations there instead.
+AUTO_CREATE_SCHEMA = os.getenv("AUTO_CREATE_SCHEMA") == "1"
 
 app = FastAPI(
     title="FastAPI WebSocket Chat",
     description="A real-time chat application using FastAPI, SQLite, and WebSockets",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -52,6 +58,9 @@ async def startup_event():
     """Initialize the application on startup"""
     # You can add initialization code here
     print("Starting up the FastAPI WebSocket Chat API...")
+    if AUTO_CREATE_SCHEMA:
+        models.Base.metadata.create_all(bind=engine)
+    await warm_up_password_hashing()
 
 
 @app.on_event("shutdown")
@@ -59,6 +68,8 @@ async def shutdown_event():
     """Clean up on application shutdown"""
     # You can add cleanup code here
     print("Shutting down the FastAPI WebSocket Chat API...")
+    await message_writer.close()
+    await dispose_async_engine()
 
 
 # For testing purposes, a simple WebSocket echo endpoint
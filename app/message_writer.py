@@ -0,0 +1,121 @@
+import asyncio
+from datetime import datetime
+from typing import List, Optional, Tuple
+from sqlalchemy import select
+
+from . import models
+from .database import SessionLocal
+
+# Maximum number of messages written in one transaction
+MAX_BATCH_SIZE = 100
+
+
+class MessageWriter:
+    """
+    Persist chat messages off the event loop.
+
+    Messages queued by concurrent handlers are written together, one
+    transaction per batch, on a worker thread with its own session, so a
+    commit never blocks the event loop.
+    """
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def save(self, content: str, user_id: int, room_id: int) -> Tuple[int, datetime]:
+        """
+        Store a message and wait until it is committed.
+
+        Returns:
+            tuple: The new message's ``(id, created_at)``.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # First use, or the previous loop is gone (e.g. between test clients)
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+
+        future = loop.create_future()
+        self._queue.put_nowait(((content, user_id, room_id), future))
+        return await future
+
+    async def close(self):
+        """Stop the writer task"""
+        if self._task is not None:
+            self._task.cancel()
+        self._task = self._queue = self._loop = None
+
+    async def _run(self):
+        """Drain the queue, writing everything that is ready as one batch"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < MAX_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            try:
+                results = await loop.run_in_executor(
+                    None, self._persist, [row for row, _ in batch]
+                )
+            except Exception as error:
+                if len(batch) == 1:
+                    self._resolve(batch[0][1], error=error)
+                    continue
+                # Don't let one bad message fail the rest of the batch
+                for row, future in batch:
+                    try:
+                        (result,) = await loop.run_in_executor(None, self._persist, [row])
+                    except Exception as row_error:
+                        self._resolve(future, error=row_error)
+                    else:
+                        self._resolve(future, result)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                self._resolve(future, result)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result=None, error: Optional[BaseException] = None):
+        """Complete a waiting save() unless its caller has gone away"""
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    @staticmethod
+    def _persist(rows: List[Tuple[str, int, int]]) -> List[Tuple[int, datetime]]:
+        """Insert messages in one transaction; blocking, runs on a worker thread"""
+        db = SessionLocal()
+        try:
+            messages = [
+                models.Message(content=content, user_id=user_id, room_id=room_id)
+                for content, user_id, room_id in rows
+            ]
+            db.add_all(messages)
+            db.flush()
+            ids = [message.id for message in messages]
+            db.commit()
+
+            # created_at is a server default; fetch it for the whole batch at once
+            created = dict(db.execute(
+                select(models.Message.id, models.Message.created_at)
+                .where(models.Message.id.in_(ids))
+            ).all())
+            return [(message_id, created[message_id]) for message_id in ids]
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+# Global message writer instance
+message_writer = MessageWriter()
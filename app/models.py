@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -50,13 +50,18 @@ class Message(Base):
     id = Column(Integer, primary_key=True, index=True)
     content = Column(Text)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     room_id = Column(Integer, ForeignKey("chat_rooms.id"))
     
     # Relationships
     user = relationship("User", back_populates="messages")
     room = relationship("ChatRoom", back_populates="messages")
 
+    # Serves "latest messages in a room" without a full scan and sort
+    __table_args__ = (
+        Index("ix_messages_room_created", "room_id", created_at.desc(), id.desc()),
+    )
+
 
 class WebSocketConnection(Base):
     __tablename__ = "websocket_connections"
@@ -1,8 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
+import orjson
+import re
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from typing import List
-from datetime import timedelta
+from typing import List, Optional
 
 from .. import models, schemas
 from ..database import get_db
@@ -11,7 +14,10 @@ from ..dependencies import (
     authenticate_user,
     create_access_token,
     get_password_hash,
-    ACCESS_TOKEN_EXPIRE_MINUTES
+    get_room_membership,
+    invalidate_user_cache,
+    UserRecord,
+    ACCESS_TOKEN_EXPIRE
 )
 from ..websocket_manager import manager
 
@@ -26,58 +32,72 @@ async def login_for_access_token(
     """
     Get an access token for authentication
     """
-    print(111)
-    print(form_data)
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data={"sub": user.username}, expires_delta=ACCESS_TOKEN_EXPIRE
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+# Unique users columns, by the field name reported for a duplicate signup
+_UNIQUE_USER_FIELDS = {"username": "Username", "email": "Email"}
+
+
+def _duplicate_user_field(error: IntegrityError) -> Optional[str]:
+    """
+    The field a signup collided on, or None if it wasn't a duplicate user.
+
+    PostgreSQL drivers name the violated unique index (ix_users_<column>);
+    SQLite names the column in a fixed message. Neither includes the
+    submitted values, so a username can't be mistaken for the email.
+    """
+    diag = getattr(error.orig, "diag", None)
+    if constraint := getattr(diag, "constraint_name", None):
+        match = re.fullmatch(r"ix_users_(\w+)", constraint)
+    else:
+        match = re.fullmatch(r"UNIQUE constraint failed: users\.(\w+)", str(error.orig))
+    return _UNIQUE_USER_FIELDS.get(match.group(1)) if match else None
+
+
 @router.post("/users/", response_model=schemas.User)
 async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     """
     Create a new user
     """
-    # Check if username already exists
-    db_user = db.query(models.User).filter(models.User.username == user.username).first()
-    if db_user:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Username already registered"
-        )
-    
-    # Check if email already exists
-    db_user = db.query(models.User).filter(models.User.email == user.email).first()
-    if db_user:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Email already registered"
-        )
-    
-    # Create new user
-    hashed_password = get_password_hash(user.password)
+    # Create new user; the unique constraints on username and email reject
+    # duplicates, so no pre-check queries are needed. The trade-off is that
+    # a duplicate signup still pays for a full (off-loop) bcrypt hash before
+    # its INSERT fails; signups are rare next to the queries this saves
+    hashed_password = await get_password_hash(user.password)
     db_user = models.User(
         username=user.username,
         email=user.email,
         hashed_password=hashed_password
     )
     db.add(db_user)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError as e:
+        db.rollback()
+        if (field := _duplicate_user_field(e)) is None:
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{field} already registered"
+        )
     db.refresh(db_user)
+    invalidate_user_cache(db_user.username)
     return db_user
 
 
 @router.get("/users/me/", response_model=schemas.User)
-async def read_users_me(current_user: models.User = Depends(get_current_active_user)):
+async def read_users_me(current_user: UserRecord = Depends(get_current_active_user)):
     """
     Get current user information
     """
@@ -88,7 +108,7 @@ async def read_users_me(current_user: models.User = Depends(get_current_active_u
 async def create_chat_room(
     room: schemas.ChatRoomCreate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_active_user)
+    current_user: UserRecord = Depends(get_current_active_user)
 ):
     """
     Create a new chat room
@@ -109,6 +129,7 @@ async def create_chat_room(
     db.add(db_room)
     db.commit()
     db.refresh(db_room)
+    manager.invalidate_room(db_room.id)
     
     # Add current user to the room
     user_room = models.UserRoom(user_id=current_user.id, room_id=db_room.id)
@@ -123,19 +144,27 @@ async def get_chat_rooms(
     skip: int = 0,
     limit: int = 100,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_active_user)
+    current_user: UserRecord = Depends(get_current_active_user)
 ):
     """
     Get all chat rooms
     """
-    return db.query(models.ChatRoom).offset(skip).limit(limit).all()
+    # Select only the columns in the response schema; no relationships are
+    # loaded, so there is nothing to lazy-load per row
+    stmt = select(
+        models.ChatRoom.id,
+        models.ChatRoom.name,
+        models.ChatRoom.description,
+        models.ChatRoom.created_at,
+    ).offset(skip).limit(limit)
+    return [row._asdict() for row in db.execute(stmt)]
 
 
 @router.get("/rooms/{room_id}", response_model=schemas.ChatRoom)
 async def get_chat_room(
     room_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_active_user)
+    current_user: UserRecord = Depends(get_current_active_user)
 ):
     """
     Get a specific chat room
@@ -157,25 +186,19 @@ async def get_chat_room(
 async def join_chat_room(
     room_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_active_user)
+    current_user: UserRecord = Depends(get_current_active_user)
 ):
     """
     Join a chat room
     """
-    # Check if room exists
-    room = db.query(models.ChatRoom).filter(models.ChatRoom.id == room_id).first()
+    # Check if room exists and whether the user is already a member of it
+    room, user_room = get_room_membership(db, room_id, current_user.id)
     if not room:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Chat room not found"
         )
     
-    # Check if user is already in the room
-    user_room = db.query(models.UserRoom).filter(
-        models.UserRoom.user_id == current_user.id,
-        models.UserRoom.room_id == room_id
-    ).first()
-    
     if user_room:
         return {"message": "Already a member of this room"}
     
@@ -185,13 +208,13 @@ async def join_chat_room(
     db.commit()
     
     # Notify users in the room
-    await manager.broadcast_to_room(
-        {
+    await manager.broadcast_bytes_to_room(
+        orjson.dumps({
             "type": "user_joined",
             "user_id": current_user.id,
             "username": current_user.username,
             "room_id": room_id
-        },
+        }),
         room_id
     )
     
@@ -202,25 +225,19 @@ async def join_chat_room(
 async def leave_chat_room(
     room_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_active_user)
+    current_user: UserRecord = Depends(get_current_active_user)
 ):
     """
     Leave a chat room
     """
-    # Check if room exists
-    room = db.query(models.ChatRoom).filter(models.ChatRoom.id == room_id).first()
+    # Check if room exists and whether the user is a member of it
+    room, user_room = get_room_membership(db, room_id, current_user.id)
     if not room:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Chat room not found"
         )
     
-    # Check if user is in the room
-    user_room = db.query(models.UserRoom).filter(
-        models.UserRoom.user_id == current_user.id,
-        models.UserRoom.room_id == room_id
-    ).first()
-    
     if not user_room:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -232,13 +249,13 @@ async def leave_chat_room(
     db.commit()
     
     # Notify users in the room
-    await manager.broadcast_to_room(
-        {
+    await manager.broadcast_bytes_to_room(
+        orjson.dumps({
             "type": "user_left",
             "user_id": current_user.id,
             "username": current_user.username,
             "room_id": room_id
-        },
+        }),
         room_id
     )
     
@@ -251,38 +268,41 @@ async def get_room_messages(
     skip: int = 0,
     limit: int = 100,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_active_user)
+    current_user: UserRecord = Depends(get_current_active_user)
 ):
     """
     Get messages from a specific chat room
     """
-    # Check if room exists
-    room = db.query(models.ChatRoom).filter(models.ChatRoom.id == room_id).first()
+    # Check if room exists and whether the user is a member of it
+    room, user_room = get_room_membership(db, room_id, current_user.id)
     if not room:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Chat room not found"
         )
     
-    # Check if user is in the room
-    user_room = db.query(models.UserRoom).filter(
-        models.UserRoom.user_id == current_user.id,
-        models.UserRoom.room_id == room_id
-    ).first()
-    
     if not user_room:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not a member of this room"
         )
     
-    # Get messages
-    messages = db.query(models.Message).filter(
+    # Page through the newest messages, then let the database return the
+    # page in chronological order. Only the response columns are selected,
+    # so no ORM objects (or lazy-loaded relationships) are involved.
+    latest = select(
+        models.Message.id,
+        models.Message.content,
+        models.Message.created_at,
+        models.Message.user_id,
+        models.Message.room_id,
+    ).where(
         models.Message.room_id == room_id
-    ).order_by(models.Message.created_at.desc()).offset(skip).limit(limit).all()
-    
-    # Return in reverse order to get chronological order
-    return list(reversed(messages))
+    ).order_by(
+        models.Message.created_at.desc(), models.Message.id.desc()
+    ).offset(skip).limit(limit).subquery()
+    stmt = select(latest).order_by(latest.c.created_at, latest.c.id)
+    return [row._asdict() for row in db.execute(stmt)]
 
 
 @router.post("/rooms/{room_id}/messages", response_model=schemas.Message)
@@ -290,25 +310,19 @@ async def create_message(
     room_id: int,
     message: schemas.MessageCreate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(get_current_active_user)
+    current_user: UserRecord = Depends(get_current_active_user)
 ):
     """
     Create a new message in a chat room
     """
-    # Check if room exists
-    room = db.query(models.ChatRoom).filter(models.ChatRoom.id == room_id).first()
+    # Check if room exists and whether the user is a member of it
+    room, user_room = get_room_membership(db, room_id, current_user.id)
     if not room:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Chat room not found"
         )
     
-    # Check if user is in the room
-    user_room = db.query(models.UserRoom).filter(
-        models.UserRoom.user_id == current_user.id,
-        models.UserRoom.room_id == room_id
-    ).first()
-    
     if not user_room:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -326,16 +340,16 @@ async def create_message(
     db.refresh(db_message)
     
     # Broadcast message to WebSocket clients
-    await manager.broadcast_to_room(
-        {
+    await manager.broadcast_bytes_to_room(
+        orjson.dumps({
             "type": "message",
             "id": db_message.id,
             "content": db_message.content,
             "user_id": current_user.id,
             "username": current_user.username,
             "room_id": room_id,
-            "timestamp": db_message.created_at.isoformat()
-        },
+            "timestamp": db_message.created_at
+        }),
         room_id
     )
     
@@ -1,58 +1,254 @@
-import json
+import msgspec
+import orjson
 from typing import Optional
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
 
 from .. import models, schemas
-from ..database import get_db
-from ..dependencies import get_user_from_ws_token
+from ..database import get_async_db
+from ..dependencies import add_room_member, get_user_from_ws_token
+from ..message_writer import message_writer
 from ..websocket_manager import manager
 
 router = APIRouter()
 
+# Decodes client frames straight into WebSocketMessage; lax mode keeps
+# accepting numeric fields sent as strings, e.g. "room_id": "1"
+_message_decoder = msgspec.json.Decoder(schemas.WebSocketMessage, strict=False)
+
+# Static error frames, serialized once
+ERR_BAD_JSON = orjson.dumps({"type": "error", "content": "Invalid JSON format"})
+ERR_MISSING_CONTENT_OR_ROOM = orjson.dumps({"type": "error", "content": "Missing content or room_id"})
+ERR_MISSING_CONTENT = orjson.dumps({"type": "error", "content": "Missing content"})
+ERR_MISSING_ROOM = orjson.dumps({"type": "error", "content": "Missing room_id"})
+ERR_JOIN_FAILED = orjson.dumps({"type": "error", "content": "Failed to join room"})
+ERR_LEAVE_FAILED = orjson.dumps({"type": "error", "content": "Failed to leave room"})
+ERR_SAVE_FAILED = orjson.dumps({"type": "error", "content": "Failed to save message"})
+
+
+async def _receive_payload(websocket: WebSocket):
+    """
+    Receive the next frame's raw payload without decoding it.
+
+    Binary frames are returned as bytes and text frames as str; the JSON
+    decoders accept either directly.
+
+    Raises:
+        WebSocketDisconnect: If the client disconnected
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    data = message.get("bytes")
+    return data if data is not None else message["text"]
+
 
 @router.websocket("/ws")
 async def websocket_endpoint(
     websocket: WebSocket,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Main WebSocket endpoint for general notifications"""
     client_id = await manager.connect(websocket)
     
     try:
         while True:
-            data = await websocket.receive_text()
+            data = await _receive_payload(websocket)
+            manager.touch(client_id)
             try:
-                # Parse the incoming message
-                message_data = json.loads(data)
+                # Parse the incoming message; any JSON is echoed back, so
+                # this endpoint doesn't decode into WebSocketMessage
+                message_data = orjson.loads(data)
                 message_type = message_data.get("type", "message")
                 
                 # Handle different message types
                 if message_type == "ping":
-                    await manager.send_personal_message(
-                        {"type": "pong", "timestamp": datetime.now().isoformat()},
-                        client_id
-                    )
+                    await manager.send_personal_bytes(manager.pong_payload(), client_id)
                 else:
                     # Echo the message back
+                    if isinstance(data, bytes):
+                        data = data.decode("utf-8", "replace")
                     await manager.send_personal_message(
                         {"type": "echo", "content": f"Received: {data}"},
                         client_id
                     )
-            except json.JSONDecodeError:
-                await manager.send_personal_message(
-                    {"type": "error", "content": "Invalid JSON format"},
-                    client_id
-                )
+            except orjson.JSONDecodeError:
+                await manager.send_personal_bytes(ERR_BAD_JSON, client_id)
     except WebSocketDisconnect:
-        manager.disconnect(client_id, db)
+        pass
+    finally:
+        # Runs on any exit, so a crashed handler can't leave the sender task
+        # and the indexed send queue behind
+        await manager.disconnect(client_id, db)
+
+
+# Message handlers for the authenticated endpoints. Each takes the parsed
+# message, the user, the client_id, the session and the endpoint's room_id
+# (None on /ws/auth, where messages name their own room).
+
+async def _handle_message(message: schemas.WebSocketMessage, user, client_id: int, db: AsyncSession, room_id: Optional[int]):
+    """Store a chat message and broadcast it to the room it names"""
+    content = message.content
+    room_id = message.room_id
+
+    if content and room_id:
+        await _save_and_broadcast(content, user, room_id, client_id)
+    else:
+        await manager.send_personal_bytes(ERR_MISSING_CONTENT_OR_ROOM, client_id)
+
+
+async def _handle_room_message(message: schemas.WebSocketMessage, user, client_id: int, db: AsyncSession, room_id: Optional[int]):
+    """Store a chat message and broadcast it to the endpoint's room"""
+    if content := message.content:
+        await _save_and_broadcast(content, user, room_id, client_id)
+    else:
+        await manager.send_personal_bytes(ERR_MISSING_CONTENT, client_id)
+
+
+async def _save_and_broadcast(content: str, user, room_id: int, client_id: int):
+    """Persist a chat message and broadcast it to the room"""
+    # Store the message in the database without blocking the event loop. A
+    # row the database rejects is reported to the sender rather than closing
+    # the socket; any other error is a bug and ends the connection
+    try:
+        message_id, created_at = await message_writer.save(content, user.id, room_id)
+    except SQLAlchemyError:
+        await manager.send_personal_bytes(ERR_SAVE_FAILED, client_id)
+        return
+
+    # Broadcast the message to the room
+    await manager.broadcast_to_room(
+        {
+            "type": "message",
+            "id": message_id,
+            "content": content,
+            "user_id": user.id,
+            "username": user.username,
+            "room_id": room_id,
+            "timestamp": created_at
+        },
+        room_id
+    )
+
+
+async def _handle_join_room(message: schemas.WebSocketMessage, user, client_id: int, db: AsyncSession, room_id: Optional[int]):
+    """Join the room named in the message"""
+    if not (room_id := message.room_id):
+        await manager.send_personal_bytes(ERR_MISSING_ROOM, client_id)
+        return
+
+    if not (room := await manager.get_room(room_id, db)):
+        await manager.send_personal_message(
+            {"type": "error", "content": f"Room {room_id} does not exist"},
+            client_id
+        )
+        return
+
+    # Add user to room if not already a member; committed
+    # together with the connection update in join_room
+    await add_room_member(db, user.id, room_id)
+
+    if await manager.join_room(client_id, room_id, db):
+        # Notify the user
+        await manager.send_personal_message(
+            {"type": "room_joined", "room_id": room_id, "room_name": room.name},
+            client_id
+        )
+
+        # Notify other users in the room
+        await manager.broadcast_to_room(
+            {
+                "type": "user_joined",
+                "user_id": user.id,
+                "username": user.username,
+                "room_id": room_id,
+                "timestamp": datetime.now()
+            },
+            room_id
+        )
+    else:
+        await manager.send_personal_bytes(ERR_JOIN_FAILED, client_id)
+
+
+async def _handle_leave_room(message: schemas.WebSocketMessage, user, client_id: int, db: AsyncSession, room_id: Optional[int]):
+    """Leave the room named in the message"""
+    if not (room_id := message.room_id):
+        await manager.send_personal_bytes(ERR_MISSING_ROOM, client_id)
+        return
+
+    if await manager.leave_room(client_id, room_id, db):
+        # Notify the user
+        await manager.send_personal_message(
+            {"type": "room_left", "room_id": room_id},
+            client_id
+        )
+
+        # Notify other users in the room
+        await manager.broadcast_to_room(
+            {
+                "type": "user_left",
+                "user_id": user.id,
+                "username": user.username,
+                "room_id": room_id,
+                "timestamp": datetime.now()
+            },
+            room_id
+        )
+    else:
+        await manager.send_personal_bytes(ERR_LEAVE_FAILED, client_id)
+
+
+async def _handle_typing(message: schemas.WebSocketMessage, user, client_id: int, db: AsyncSession, room_id: Optional[int]):
+    """Broadcast a typing notification to the room named in the message"""
+    if room_id := message.room_id:
+        await _handle_room_typing(message, user, client_id, db, room_id)
+
+
+async def _handle_room_typing(message: schemas.WebSocketMessage, user, client_id: int, db: AsyncSession, room_id: Optional[int]):
+    """Broadcast a typing notification to the endpoint's room"""
+    if not manager.should_emit_typing(user.id, room_id):
+        return
+    await manager.broadcast_bytes_to_room(
+        manager.typing_payload(user.id, user.username, room_id), room_id
+    )
+
+
+async def _handle_ping(message: schemas.WebSocketMessage, user, client_id: int, db: AsyncSession, room_id: Optional[int]):
+    """Answer a ping"""
+    await manager.send_personal_bytes(manager.pong_payload(), client_id)
+
+
+async def _handle_unknown(message: schemas.WebSocketMessage, user, client_id: int, db: AsyncSession, room_id: Optional[int]):
+    """Report an unsupported message type"""
+    await manager.send_personal_message(
+        {"type": "error", "content": f"Unknown message type: {message.type}"},
+        client_id
+    )
+
+
+# Message type -> handler, per endpoint
+AUTH_HANDLERS = {
+    "message": _handle_message,
+    "join_room": _handle_join_room,
+    "leave_room": _handle_leave_room,
+    "typing": _handle_typing,
+    "ping": _handle_ping,
+}
+
+ROOM_HANDLERS = {
+    "message": _handle_room_message,
+    "typing": _handle_room_typing,
+    "ping": _handle_ping,
+}
 
 
 @router.websocket("/ws/auth")
 async def websocket_auth_endpoint(
     websocket: WebSocket,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Authenticated WebSocket endpoint"""
     user = await get_user_from_ws_token(websocket, db)
@@ -74,180 +270,40 @@ async def websocket_auth_endpoint(
 
     try:
         while True:
-            data = await websocket.receive_text()
+            data = await _receive_payload(websocket)
+            manager.touch(client_id)
             try:
                 # Parse the incoming message
-                message_data = json.loads(data)
-                message_type = message_data.get("type", "message")
+                message = _message_decoder.decode(data)
 
-                if message_type == "message":
-                    content = message_data.get("content")
-                    room_id = message_data.get("room_id")
-
-                    if content and room_id:
-                        # Store the message in the database
-                        db_message = models.Message(
-                            content=content,
-                            user_id=user.id,
-                            room_id=room_id
-                        )
-                        db.add(db_message)
-                        db.commit()
-                        db.refresh(db_message)
-
-                        # Broadcast the message to the room
-                        await manager.broadcast_to_room(
-                            {
-                                "type": "message",
-                                "id": db_message.id,
-                                "content": content,
-                                "user_id": user.id,
-                                "username": user.username,
-                                "room_id": room_id,
-                                "timestamp": db_message.created_at.isoformat()
-                            },
-                            room_id
-                        )
-                    else:
-                        await manager.send_personal_message(
-                            {"type": "error", "content": "Missing content or room_id"},
-                            client_id
-                        )
-
-                elif message_type == "join_room":
-                    if room_id := message_data.get("room_id"):
-                        if (
-                            room := db.query(models.ChatRoom)
-                            .filter(models.ChatRoom.id == room_id)
-                            .first()
-                        ):
-                            # Add user to room if not already a member
-                            user_room = db.query(models.UserRoom).filter(
-                                models.UserRoom.user_id == user.id,
-                                models.UserRoom.room_id == room_id
-                            ).first()
-
-                            if not user_room:
-                                user_room = models.UserRoom(user_id=user.id, room_id=room_id)
-                                db.add(user_room)
-                                db.commit()
-
-                            if success := manager.join_room(
-                                client_id, room_id, db
-                            ):
-                                # Notify the user
-                                await manager.send_personal_message(
-                                    {"type": "room_joined", "room_id": room_id, "room_name": room.name},
-                                    client_id
-                                )
-
-                                # Notify other users in the room
-                                await manager.broadcast_to_room(
-                                    {
-                                        "type": "user_joined",
-                                        "user_id": user.id,
-                                        "username": user.username,
-                                        "room_id": room_id,
-                                        "timestamp": datetime.now().isoformat()
-                                    },
-                                    room_id
-                                )
-                            else:
-                                await manager.send_personal_message(
-                                    {"type": "error", "content": "Failed to join room"},
-                                    client_id
-                                )
-                        else:
-                            await manager.send_personal_message(
-                                {"type": "error", "content": f"Room {room_id} does not exist"},
-                                client_id
-                            )
-                    else:
-                        await manager.send_personal_message(
-                            {"type": "error", "content": "Missing room_id"},
-                            client_id
-                        )
-
-                elif message_type == "leave_room":
-                    if room_id := message_data.get("room_id"):
-                        if success := manager.leave_room(
-                            client_id, room_id, db
-                        ):
-                            # Notify the user
-                            await manager.send_personal_message(
-                                {"type": "room_left", "room_id": room_id},
-                                client_id
-                            )
-
-                            # Notify other users in the room
-                            await manager.broadcast_to_room(
-                                {
-                                    "type": "user_left",
-                                    "user_id": user.id,
-                                    "username": user.username,
-                                    "room_id": room_id,
-                                    "timestamp": datetime.now().isoformat()
-                                },
-                                room_id
-                            )
-                        else:
-                            await manager.send_personal_message(
-                                {"type": "error", "content": "Failed to leave room"},
-                                client_id
-                            )
-                    else:
-                        await manager.send_personal_message(
-                            {"type": "error", "content": "Missing room_id"},
-                            client_id
-                        )
-
-                elif message_type == "typing":
-                    if room_id := message_data.get("room_id"):
-                        # Broadcast typing notification to room
-                        await manager.broadcast_to_room(
-                            {
-                                "type": "user_typing",
-                                "user_id": user.id,
-                                "username": user.username,
-                                "room_id": room_id,
-                                "timestamp": datetime.now().isoformat()
-                            },
-                            room_id
-                        )
-
-                elif message_type == "ping":
-                    await manager.send_personal_message(
-                        {"type": "pong", "timestamp": datetime.now().isoformat()},
-                        client_id
-                    )
+                handler = AUTH_HANDLERS.get(message.type, _handle_unknown)
+                await handler(message, user, client_id, db, None)
 
-                else:
-                    # Handle unknown message types
-                    await manager.send_personal_message(
-                        {"type": "error", "content": f"Unknown message type: {message_type}"},
-                        client_id
-                    )
-
-            except json.JSONDecodeError:
+            except msgspec.ValidationError as error:
+                # Well-formed JSON, but not a message this server understands
                 await manager.send_personal_message(
-                    {"type": "error", "content": "Invalid JSON format"},
+                    {"type": "error", "content": f"Invalid message: {error}"},
                     client_id
                 )
+            except msgspec.DecodeError:
+                await manager.send_personal_bytes(ERR_BAD_JSON, client_id)
     except WebSocketDisconnect:
-        # Handle disconnect
-        manager.disconnect(client_id, db)
-
-        if room_id := manager.connection_info.get(client_id, {}).get(
-            "room_id"
-        ):
-            # Notify others in the room
+        pass
+    finally:
+        # Handle disconnect on any exit, remembering the rooms before the
+        # metadata is dropped
+        info = manager.connection_info.get(client_id)
+        await manager.disconnect(client_id, db)
+
+        for room_id in info.rooms if info else ():
+            # Notify others in each room
             await manager.broadcast_to_room(
                 {
                     "type": "user_disconnected",
                     "user_id": user.id,
                     "username": user.username,
                     "room_id": room_id,
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": datetime.now()
                 },
                 room_id
             )
@@ -257,7 +313,7 @@ async def websocket_auth_endpoint(
 async def websocket_room_endpoint(
     websocket: WebSocket,
     room_id: int,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Room-specific WebSocket endpoint"""
     user = await get_user_from_ws_token(websocket, db)
@@ -265,47 +321,67 @@ async def websocket_room_endpoint(
         return  # WebSocket already closed in the dependency
 
     # Check if room exists
-    room = db.query(models.ChatRoom).filter(models.ChatRoom.id == room_id).first()
+    room = await manager.get_room(room_id, db)
     if not room:
         await websocket.close(code=1008, reason=f"Room {room_id} does not exist")
         return
 
-    # Check if user is a member of the room
-    user_room = db.query(models.UserRoom).filter(
-        models.UserRoom.user_id == user.id,
-        models.UserRoom.room_id == room_id
-    ).first()
-
-    if not user_room:
-        # Auto-join the room
-        user_room = models.UserRoom(user_id=user.id, room_id=room_id)
-        db.add(user_room)
-        db.commit()
+    # Auto-join the room if not already a member; committed together with
+    # the connection record in connect
+    await add_room_member(db, user.id, room_id)
 
     # Connect to WebSocket and join room
     client_id = await manager.connect(websocket, user_id=user.id, room_id=room_id, db=db)
 
-    # Send recent messages from the room
-    recent_messages = db.query(models.Message).filter(
-        models.Message.room_id == room_id
-    ).order_by(models.Message.created_at.desc()).limit(50).all()
+    try:
+        await _serve_room(websocket, user, client_id, db, room_id)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Handle disconnect on any exit
+        await manager.disconnect(client_id, db)
 
-    # Reverse to get chronological order
-    recent_messages = list(reversed(recent_messages))
+        # Notify others in the room
+        await manager.broadcast_to_room(
+            {
+                "type": "user_disconnected",
+                "user_id": user.id,
+                "username": user.username,
+                "room_id": room_id,
+                "timestamp": datetime.now()
+            },
+            room_id
+        )
 
-    # Send message history
+
+async def _serve_room(websocket: WebSocket, user, client_id: int, db: AsyncSession, room_id: int):
+    """Send a new room connection its history, then handle its messages"""
+    # Send recent messages from the room, as plain rows rather than ORM objects
+    recent_messages = (await db.execute(
+        select(
+            models.Message.id,
+            models.Message.content,
+            models.Message.user_id,
+            models.Message.created_at
+        )
+        .where(models.Message.room_id == room_id)
+        .order_by(models.Message.created_at.desc(), models.Message.id.desc())
+        .limit(50)
+    )).all()
+
+    # Send message history, reversed to get chronological order
     await manager.send_personal_message(
         {
             "type": "message_history",
             "room_id": room_id,
             "messages": [
                 {
-                    "id": msg.id,
-                    "content": msg.content,
-                    "user_id": msg.user_id,
-                    "timestamp": msg.created_at.isoformat()
+                    "id": msg_id,
+                    "content": content,
+                    "user_id": user_id,
+                    "timestamp": created_at
                 }
-                for msg in recent_messages
+                for msg_id, content, user_id, created_at in reversed(recent_messages)
             ]
         },
         client_id
@@ -318,99 +394,32 @@ async def websocket_room_endpoint(
             "user_id": user.id,
             "username": user.username,
             "room_id": room_id,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": datetime.now()
         },
         room_id
     )
 
-    try:
-        while True:
-            data = await websocket.receive_text()
-            try:
-                # Parse the incoming message
-                message_data = json.loads(data)
-                message_type = message_data.get("type", "message")
-
-                if message_type == "message":
-                    if content := message_data.get("content"):
-                        # Store the message in the database
-                        db_message = models.Message(
-                            content=content,
-                            user_id=user.id,
-                            room_id=room_id
-                        )
-                        db.add(db_message)
-                        db.commit()
-                        db.refresh(db_message)
-
-                        # Broadcast the message to the room
-                        await manager.broadcast_to_room(
-                            {
-                                "type": "message",
-                                "id": db_message.id,
-                                "content": content,
-                                "user_id": user.id,
-                                "username": user.username,
-                                "room_id": room_id,
-                                "timestamp": db_message.created_at.isoformat()
-                            },
-                            room_id
-                        )
-                    else:
-                        await manager.send_personal_message(
-                            {"type": "error", "content": "Missing content"},
-                            client_id
-                        )
-
-                elif message_type == "typing":
-                    # Broadcast typing notification to room
-                    await manager.broadcast_to_room(
-                        {
-                            "type": "user_typing",
-                            "user_id": user.id,
-                            "username": user.username,
-                            "room_id": room_id,
-                            "timestamp": datetime.now().isoformat()
-                        },
-                        room_id
-                    )
-
-                elif message_type == "ping":
-                    await manager.send_personal_message(
-                        {"type": "pong", "timestamp": datetime.now().isoformat()},
-                        client_id
-                    )
-
-                else:
-                    # Handle unknown message types
-                    await manager.send_personal_message(
-                        {"type": "error", "content": f"Unknown message type: {message_type}"},
-                        client_id
-                    )
-
-            except json.JSONDecodeError:
-                await manager.send_personal_message(
-                    {"type": "error", "content": "Invalid JSON format"},
-                    client_id
-                )
-    except WebSocketDisconnect:
-        # Handle disconnect
-        manager.disconnect(client_id, db)
-
-        # Notify others in the room
-        await manager.broadcast_to_room(
-            {
-                "type": "user_disconnected",
-                "user_id": user.id,
-                "username": user.username,
-                "room_id": room_id,
-                "timestamp": datetime.now().isoformat()
-            },
-            room_id
-        )
+    while True:
+        data = await _receive_payload(websocket)
+        manager.touch(client_id)
+        try:
+            # Parse the incoming message
+            message = _message_decoder.decode(data)
+
+            handler = ROOM_HANDLERS.get(message.type, _handle_unknown)
+            await handler(message, user, client_id, db, room_id)
+
+        except msgspec.ValidationError as error:
+            # Well-formed JSON, but not a message this server understands
+            await manager.send_personal_message(
+                {"type": "error", "content": f"Invalid message: {error}"},
+                client_id
+            )
+        except msgspec.DecodeError:
+            await manager.send_personal_bytes(ERR_BAD_JSON, client_id)
 
 
-@router.get("/connections", response_model=schemas.WSConnectionInfo)
+@router.get("/connections")
 async def get_connection_info():
     """Get information about WebSocket connections"""
     return manager.get_connections_info()
\ No newline at end of file
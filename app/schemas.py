@@ -1,6 +1,7 @@
-from pydantic import BaseModel, EmailStr, Field
+from pydantic import BaseModel, ConfigDict, EmailStr
 from typing import List, Optional
 from datetime import datetime
+import msgspec
 
 
 class UserBase(BaseModel):
@@ -16,8 +17,7 @@ class User(UserBase):
     id: int
     is_active: bool
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class Token(BaseModel):
@@ -42,8 +42,7 @@ class ChatRoom(ChatRoomBase):
     id: int
     created_at: datetime
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class MessageBase(BaseModel):
@@ -60,20 +59,23 @@ class Message(MessageBase):
     created_at: datetime
     user_id: int
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
-class WebSocketMessage(BaseModel):
-    type: str  # message, join, leave, etc.
+class WebSocketMessage(msgspec.Struct):
+    """
+    A frame received from a client, decoded straight from JSON by msgspec.
+
+    Only the fields the server reads are declared; anything else a client
+    sends (user_id, timestamp, ...) is ignored rather than validated.
+    """
+    type: str = "message"  # message, join, leave, etc.
     content: Optional[str] = None
     room_id: Optional[int] = None
-    user_id: Optional[int] = None
-    timestamp: Optional[datetime] = Field(default_factory=datetime.now)
 
 
 class WSConnectionStatus(BaseModel):
-    client_id: str
+    client_id: int
     is_connected: bool
     connected_at: Optional[datetime] = None
     user_id: Optional[int] = None
@@ -1,241 +1,399 @@
-import json
-import uuid
-from typing import Dict, List, Set, Optional
+import asyncio
+import contextlib
+import itertools
+import secrets
+import time
+import orjson
+from typing import Dict, List, Optional, Set
+from cachetools import TTLCache
+from dataclasses import dataclass
 from fastapi import WebSocket, WebSocketDisconnect
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
 
-from . import models, schemas
+from . import models
+
+# Maximum number of frames buffered per client before it is disconnected
+SEND_QUEUE_SIZE = 1024
+
+# Maximum number of queued messages coalesced into one batch frame
+MAX_BATCH_SIZE = 128
+
+# Seconds a room lookup (including "no such room") is served from cache
+ROOM_CACHE_TTL = 60
+
+# Seconds during which repeated typing events from a user in a room are dropped
+TYPING_DEBOUNCE = 1.0
+
+
+@dataclass
+class ConnectionInfo:
+    """Metadata about a single connection"""
+    __slots__ = ("user_id", "rooms", "queue", "connected_at", "last_active")
+
+    user_id: Optional[int]
+    # Rooms the client is indexed under; a client may join several
+    rooms: Set[int]
+    # Outbound frames, drained by the connection's sender task
+    queue: asyncio.Queue
+    connected_at: datetime
+    # time.monotonic() of the last frame received from the client
+    last_active: float
 
 
 class ConnectionManager:
     def __init__(self):
         # Active connections by client_id
-        self.active_connections: Dict[str, WebSocket] = {}
+        self.active_connections: Dict[int, WebSocket] = {}
         
-        # Map of room_id to set of client_ids
-        self.room_connections: Dict[int, Set[str]] = {}
+        # Map of room_id to {client_id: send queue}, so a broadcast walks the
+        # queues directly without a lookup per recipient
+        self.room_connections: Dict[int, Dict[int, asyncio.Queue]] = {}
         
-        # Map of user_id to set of client_ids (a user might have multiple devices connected)
-        self.user_connections: Dict[int, Set[str]] = {}
+        # Map of user_id to {client_id: send queue} (a user might have multiple devices connected)
+        self.user_connections: Dict[int, Dict[int, asyncio.Queue]] = {}
         
         # Keep metadata about connections
-        self.connection_info: Dict[str, dict] = {}
+        self.connection_info: Dict[int, ConnectionInfo] = {}
+
+        # Sender task per client_id
+        self.sender_tasks: Dict[int, asyncio.Task] = {}
+
+        # Client IDs are small ints from a counter; the database row for a
+        # connection is keyed "<per-process random prefix>-<client_id>" so
+        # rows stay unique across restarts
+        self._id_prefix = secrets.token_hex(4)
+        self._id_counter = itertools.count()
 
-    async def connect(self, websocket: WebSocket, client_id: str = None, user_id: Optional[int] = None, room_id: Optional[int] = None, db: Session = None):
+        # Serialized pong frame, rebuilt when the wall-clock second changes
+        self._pong_second: Optional[int] = None
+        self._pong_payload: bytes = b""
+
+        # (user_id, room_id) pairs that broadcast a typing event recently;
+        # entries expire on their own, so nothing needs pruning
+        self._typing_debounce: TTLCache = TTLCache(maxsize=10_000, ttl=TYPING_DEBOUNCE)
+
+        # Room rows (id, name, description) by room_id; None for missing rooms
+        self._room_cache: TTLCache = TTLCache(maxsize=10_000, ttl=ROOM_CACHE_TTL)
+
+    async def connect(self, websocket: WebSocket, client_id: Optional[int] = None, user_id: Optional[int] = None, room_id: Optional[int] = None, db: AsyncSession = None):
         """Connect a client to the WebSocket manager"""
         await websocket.accept()
         
         # Generate a client ID if none provided
-        if not client_id:
-            client_id = str(uuid.uuid4())
+        if client_id is None:
+            client_id = next(self._id_counter)
         
         # Store the connection
         self.active_connections[client_id] = websocket
+
+        # Start the sender task that owns all writes to this socket
+        queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.sender_tasks[client_id] = asyncio.create_task(
+            self._sender_loop(client_id, websocket, queue)
+        )
         
         # Store connection metadata
-        self.connection_info[client_id] = {
-            "user_id": user_id,
-            "room_id": room_id,
-            "connected_at": datetime.now(),
-            "last_active": datetime.now()
-        }
+        self.connection_info[client_id] = ConnectionInfo(
+            user_id=user_id,
+            rooms={room_id} if room_id else set(),
+            queue=queue,
+            connected_at=datetime.now(),
+            last_active=time.monotonic()
+        )
         
         # If room_id is provided, add to room connections
         if room_id:
-            if room_id not in self.room_connections:
-                self.room_connections[room_id] = set()
-            self.room_connections[room_id].add(client_id)
+            self._add_to_room(client_id, room_id, queue)
         
         # If user_id is provided, add to user connections
         if user_id:
-            if user_id not in self.user_connections:
-                self.user_connections[user_id] = set()
-            self.user_connections[user_id].add(client_id)
+            self.user_connections.setdefault(user_id, {})[client_id] = queue
         
         # If database session is provided, store connection info
         if db:
+            row_id = self._row_id(client_id)
             db_connection = models.WebSocketConnection(
-                id=client_id,
+                id=row_id,
                 user_id=user_id,
                 room_id=room_id,
-                client_id=client_id,
+                client_id=row_id,
                 connected_at=datetime.now(),
                 is_active=True
             )
             db.add(db_connection)
-            db.commit()
+            await db.commit()
         
         return client_id
 
-    def disconnect(self, client_id: str, db: Session = None):
+    def _row_id(self, client_id: int) -> str:
+        """Database id of a connection's websocket_connections row"""
+        return f"{self._id_prefix}-{client_id}"
+
+    async def disconnect(self, client_id: int, db: AsyncSession = None):
         """Disconnect a client from the WebSocket manager"""
         if client_id not in self.active_connections:
             return
-        # Get metadata before removing
-        metadata = self.connection_info.get(client_id, {})
-        user_id = metadata.get("user_id")
-        room_id = metadata.get("room_id")
-
-        # Remove from active connections
+        # Remove from active connections, keeping the metadata for cleanup
         self.active_connections.pop(client_id)
-        self.connection_info.pop(client_id, None)
+        metadata = self.connection_info.pop(client_id, None)
+        user_id = metadata.user_id if metadata else None
+        rooms = metadata.rooms if metadata else ()
+
+        # Stop the sender task; anything still queued is for a closed socket
+        if sender := self.sender_tasks.pop(client_id, None):
+            sender.cancel()
 
-        # Remove from room connections
-        if room_id and room_id in self.room_connections:
-            if client_id in self.room_connections[room_id]:
-                self.room_connections[room_id].remove(client_id)
-            if not self.room_connections[room_id]:  # If room is empty
-                self.room_connections.pop(room_id)
+        # Remove from every room the client joined
+        for room_id in rooms:
+            self._remove_from_room(client_id, room_id)
 
         # Remove from user connections
         if user_id and user_id in self.user_connections:
-            if client_id in self.user_connections[user_id]:
-                self.user_connections[user_id].remove(client_id)
+            self.user_connections[user_id].pop(client_id, None)
             if not self.user_connections[user_id]:  # If user has no connections
                 self.user_connections.pop(user_id)
 
             # Update database if session provided
         if db:
-            if (
-                db_connection := db.query(models.WebSocketConnection)
-                .filter(models.WebSocketConnection.id == client_id)
-                .first()
-            ):
-                db_connection.is_active = False
-                db.commit()
-
-    async def send_personal_message(self, message: dict, client_id: str):
+            await db.execute(
+                update(models.WebSocketConnection)
+                .where(models.WebSocketConnection.id == self._row_id(client_id))
+                .values(is_active=False)
+            )
+            await db.commit()
+
+    def _add_to_room(self, client_id: int, room_id: int, queue: asyncio.Queue):
+        """Index a client's send queue under a room"""
+        self.room_connections.setdefault(room_id, {})[client_id] = queue
+
+    def _remove_from_room(self, client_id: int, room_id: int) -> bool:
+        """Drop a client from a room's index; False if it wasn't in the room"""
+        members = self.room_connections.get(room_id)
+        if not members or client_id not in members:
+            return False
+        del members[client_id]
+
+        if not members:  # If room is empty
+            del self.room_connections[room_id]
+        return True
+
+    async def _sender_loop(self, client_id: int, websocket: WebSocket, queue: asyncio.Queue):
+        """
+        Write queued frames to a client's socket.
+
+        Frames queued while the socket is idle are sent unchanged. Frames
+        that pile up while a send is in progress are coalesced into a single
+        ``{"type": "batch", "items": [...]}`` frame, so a backlog costs one
+        send instead of one per message. A None in the queue means the
+        client fell too far behind (see _enqueue): the socket is closed with
+        1013 so the client reconnects and reloads history.
+        """
+        # A failed send means the socket is gone; the endpoint's receive loop
+        # sees the disconnect and cleans up the connection. Anything else is
+        # a bug and propagates, so the task's failure is reported
+        with contextlib.suppress(WebSocketDisconnect, RuntimeError, OSError):
+            while True:
+                ready = [await queue.get()]
+                while not queue.empty():
+                    ready.append(queue.get_nowait())
+                for frame in ready:
+                    if frame is None:
+                        await websocket.close(code=1013)
+                        return
+                    await websocket.send_text(frame.decode())
+
+                # Everything queued from here on arrived during a send
+                while not queue.empty():
+                    batch = []
+                    while len(batch) < MAX_BATCH_SIZE and not queue.empty():
+                        batch.append(queue.get_nowait())
+                    if None in batch:
+                        await websocket.close(code=1013)
+                        return
+
+                    if len(batch) == 1:
+                        frame = batch[0]
+                    else:
+                        frame = b'{"type":"batch","items":[' + b",".join(batch) + b"]}"
+                    await websocket.send_text(frame.decode())
+
+    def touch(self, client_id: int):
+        """Record that a frame was received from a client"""
+        if info := self.connection_info.get(client_id):
+            info.last_active = time.monotonic()
+
+    @staticmethod
+    def _enqueue(payload: bytes, queue: asyncio.Queue):
+        """
+        Queue a serialized frame for a client.
+
+        A client whose queue is full can't keep up. Rather than dropping
+        frames it would never know it missed, its backlog is discarded and
+        replaced by None, which makes the sender close the connection.
+        """
+        try:
+            queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+    async def send_personal_message(self, message: dict, client_id: int):
         """Send a message to a specific client"""
-        if client_id in self.active_connections:
-            websocket = self.active_connections[client_id]
-            await websocket.send_text(json.dumps(message))
-            # Update last active
-            if client_id in self.connection_info:
-                self.connection_info[client_id]["last_active"] = datetime.now()
+        await self.send_personal_bytes(orjson.dumps(message), client_id)
+
+    async def send_personal_bytes(self, payload: bytes, client_id: int):
+        """Send an already serialized JSON message to a specific client"""
+        if info := self.connection_info.get(client_id):
+            self._enqueue(payload, info.queue)
+
+    def pong_payload(self) -> bytes:
+        """Serialized pong frame, timestamped to the current second"""
+        now = int(time.time())
+        if now != self._pong_second:
+            self._pong_payload = orjson.dumps(
+                {"type": "pong", "timestamp": datetime.fromtimestamp(now)}
+            )
+            self._pong_second = now
+        return self._pong_payload
+
+    def typing_payload(self, user_id: int, username: str, room_id: int) -> bytes:
+        """
+        Serialized user_typing frame.
+
+        Built per call: should_emit_typing already limits it to one per
+        user and room each TYPING_DEBOUNCE, so a cache would never hit.
+        """
+        return orjson.dumps({
+            "type": "user_typing",
+            "user_id": user_id,
+            "username": username,
+            "room_id": room_id,
+            "timestamp": datetime.now()
+        })
+
+    def should_emit_typing(self, user_id: int, room_id: int) -> bool:
+        """Whether a typing event should be broadcast, at most once per TYPING_DEBOUNCE"""
+        key = (user_id, room_id)
+        if key in self._typing_debounce:
+            return False
+        self._typing_debounce[key] = True
+        return True
 
     async def broadcast(self, message: dict):
         """Broadcast a message to all connected clients"""
-        disconnected = []
-        for client_id, websocket in self.active_connections.items():
-            try:
-                await websocket.send_text(json.dumps(message))
-                # Update last active
-                if client_id in self.connection_info:
-                    self.connection_info[client_id]["last_active"] = datetime.now()
-            except WebSocketDisconnect:
-                disconnected.append(client_id)
-        
-        # Clean up any disconnected clients
-        for client_id in disconnected:
-            self.disconnect(client_id)
+        payload = orjson.dumps(message)
+        for info in self.connection_info.values():
+            self._enqueue(payload, info.queue)
 
     async def broadcast_to_room(self, message: dict, room_id: int):
         """Broadcast a message to all clients in a specific room"""
         if room_id not in self.room_connections:
             return
-        
-        disconnected = []
-        for client_id in self.room_connections[room_id]:
-            if client_id in self.active_connections:
-                websocket = self.active_connections[client_id]
-                try:
-                    await websocket.send_text(json.dumps(message))
-                    # Update last active
-                    if client_id in self.connection_info:
-                        self.connection_info[client_id]["last_active"] = datetime.now()
-                except WebSocketDisconnect:
-                    disconnected.append(client_id)
-        
-        # Clean up any disconnected clients
-        for client_id in disconnected:
-            self.disconnect(client_id)
+        await self.broadcast_bytes_to_room(orjson.dumps(message), room_id)
+
+    async def broadcast_bytes_to_room(self, payload: bytes, room_id: int):
+        """
+        Broadcast an already serialized JSON message to all clients in a room.
+
+        Only enqueues the payload; each client's sender task does the write,
+        so a slow or backpressured socket never delays the other recipients.
+        """
+        if queues := self.room_connections.get(room_id):
+            for queue in queues.values():
+                self._enqueue(payload, queue)
 
     async def broadcast_to_user(self, message: dict, user_id: int):
         """Broadcast a message to all connections of a specific user"""
-        if user_id not in self.user_connections:
-            return
-        
-        disconnected = []
-        for client_id in self.user_connections[user_id]:
-            if client_id in self.active_connections:
-                websocket = self.active_connections[client_id]
-                try:
-                    await websocket.send_text(json.dumps(message))
-                    # Update last active
-                    if client_id in self.connection_info:
-                        self.connection_info[client_id]["last_active"] = datetime.now()
-                except WebSocketDisconnect:
-                    disconnected.append(client_id)
-        
-        # Clean up any disconnected clients
-        for client_id in disconnected:
-            self.disconnect(client_id)
-
-    def get_connections_info(self) -> schemas.WSConnectionInfo:
-        """Get information about all active connections"""
-        connections_by_room = {
-            room_id: len(clients)
-            for room_id, clients in self.room_connections.items()
+        if queues := self.user_connections.get(user_id):
+            payload = orjson.dumps(message)
+            for queue in queues.values():
+                self._enqueue(payload, queue)
+
+    async def get_room(self, room_id: int, db: AsyncSession):
+        """
+        Get a chat room's id, name and description, caching the lookup.
+
+        Rooms are effectively immutable, so joins are served from memory;
+        call invalidate_room after creating or changing a room.
+
+        Returns:
+            Row | None: The room, or None if it does not exist.
+        """
+        try:
+            return self._room_cache[room_id]
+        except KeyError:
+            pass
+
+        room = (await db.execute(
+            select(models.ChatRoom.id, models.ChatRoom.name, models.ChatRoom.description)
+            .where(models.ChatRoom.id == room_id)
+        )).one_or_none()
+        self._room_cache[room_id] = room
+        return room
+
+    def invalidate_room(self, room_id: int):
+        """Drop a cached room lookup"""
+        self._room_cache.pop(room_id, None)
+
+    def get_connections_info(self) -> dict:
+        """
+        Get information about all active connections.
+
+        Returns:
+            dict: The fields of schemas.WSConnectionInfo, as a plain dict so
+            the monitoring endpoint skips model validation.
+        """
+        return {
+            "total_connections": len(self.connection_info),
+            "active_connections": len(self.active_connections),
+            "connections_by_room": {
+                room_id: len(clients)
+                for room_id, clients in self.room_connections.items()
+            }
         }
-        return schemas.WSConnectionInfo(
-            total_connections=len(self.connection_info),
-            active_connections=len(self.active_connections),
-            connections_by_room=connections_by_room
-        )
 
-    def join_room(self, client_id: str, room_id: int, db: Session = None):
+    async def join_room(self, client_id: int, room_id: int, db: AsyncSession = None):
         """Add a client to a room"""
-        if client_id not in self.active_connections:
+        if not (info := self.connection_info.get(client_id)):
             return False
 
         # Add to room connections
-        if room_id not in self.room_connections:
-            self.room_connections[room_id] = set()
-        self.room_connections[room_id].add(client_id)
+        self._add_to_room(client_id, room_id, info.queue)
 
         # Update metadata
-        if client_id in self.connection_info:
-            self.connection_info[client_id]["room_id"] = room_id
+        info.rooms.add(room_id)
 
         # Update database if session provided
         if db:
-            if (
-                db_connection := db.query(models.WebSocketConnection)
-                .filter(models.WebSocketConnection.id == client_id)
-                .first()
-            ):
-                db_connection.room_id = room_id
-                db.commit()
+            await db.execute(
+                update(models.WebSocketConnection)
+                .where(models.WebSocketConnection.id == self._row_id(client_id))
+                .values(room_id=room_id)
+            )
+            await db.commit()
 
         return True
 
-    def leave_room(self, client_id: str, room_id: int, db: Session = None):
+    async def leave_room(self, client_id: int, room_id: int, db: AsyncSession = None):
         """Remove a client from a room"""
-        if (
-            room_id not in self.room_connections
-            or client_id not in self.room_connections[room_id]
-        ):
+        if not self._remove_from_room(client_id, room_id):
             return False
-        self.room_connections[room_id].remove(client_id)
-
-        # Clean up empty room
-        if not self.room_connections[room_id]:
-            self.room_connections.pop(room_id)
 
         # Update metadata
-        if client_id in self.connection_info:
-            self.connection_info[client_id]["room_id"] = None
+        if info := self.connection_info.get(client_id):
+            info.rooms.discard(room_id)
 
             # Update database if session provided
         if db:
-            if (
-                db_connection := db.query(models.WebSocketConnection)
-                .filter(models.WebSocketConnection.id == client_id)
-                .first()
-            ):
-                db_connection.room_id = None
-                db.commit()
+            await db.execute(
+                update(models.WebSocketConnection)
+                .where(models.WebSocketConnection.id == self._row_id(client_id))
+                .values(room_id=None)
+            )
+            await db.commit()
 
         return True
 